@@ -2,6 +2,8 @@
 # requires-python = ">=3.12"
 # dependencies = [
 #     "litellm",
+#     "orjson",
+#     "pathspec",
 #     "pyperclip",
 #     "textual",
 #     "tiktoken",
@@ -10,16 +12,20 @@
 
 from __future__ import annotations
 import asyncio
-import json
+import functools
+import io
 import os
 import re
 import shlex
 import subprocess
 import sys
+import time
 import traceback
 from pathlib import Path
 from typing import List, Dict
 
+import orjson
+import pathspec
 import pyperclip
 import litellm
 import tiktoken
@@ -71,18 +77,19 @@ DEFAULT_CFG: Dict = {
     "model_id": "cerebras/qwen-3-32b",
     "api_key": "$CEREBRAS_API_KEY",
     "default_files": ["README.md"],
+    "debug": False,
 }
 
 def load_cfg() -> Dict:
     CFG_PATH.parent.mkdir(parents=True, exist_ok=True)
     if not CFG_PATH.exists():
-        CFG_PATH.write_text(json.dumps(DEFAULT_CFG, indent=2))
+        CFG_PATH.write_bytes(orjson.dumps(DEFAULT_CFG, option=orjson.OPT_INDENT_2))
     try:
-        user_cfg = json.loads(CFG_PATH.read_text())
+        user_cfg = orjson.loads(CFG_PATH.read_bytes())
     except Exception:
         user_cfg = {}
     cfg = {**DEFAULT_CFG, **user_cfg}
-    CFG_PATH.write_text(json.dumps(cfg, indent=2))
+    CFG_PATH.write_bytes(orjson.dumps(cfg, option=orjson.OPT_INDENT_2))
     return cfg
 
 CFG = load_cfg()
@@ -101,53 +108,197 @@ API_KEY = resolve_api_key(CFG["api_key"])
 
 TOKEN_FACTOR = 0.25
 
-def repo_files() -> List[Path]:
-    ignore = Path(".maxxignore") if Path(".maxxignore").exists() else Path(".gitignore")
-    patterns = [p.strip() for p in ignore.read_text().splitlines()] if ignore.exists() else []
-    return [
-        p
-        for p in Path.cwd().rglob("*")
-        if p.is_file() and not any(p.match(pat) for pat in patterns)
-    ]
+def _valid_rule(line: str) -> bool:
+    try:
+        pathspec.GitIgnoreSpec.from_lines([line])
+        return True
+    except ValueError:
+        return False
 
-def est_tokens(txt: str) -> int:
+def load_ignore_spec(ignore: Path) -> pathspec.GitIgnoreSpec:
+    lines = [".git/", *ignore.read_text().splitlines()] if ignore.exists() else [".git/"]
     try:
-        enc = tiktoken.encoding_for_model("gpt-4")
-        return len(enc.encode(txt))
-    except Exception:
-        return int(len(txt) * TOKEN_FACTOR)
+        return pathspec.GitIgnoreSpec.from_lines(lines)
+    except ValueError:
+        # e.g. a lone "!" or trailing "\": git ignores such lines, so do we
+        return pathspec.GitIgnoreSpec.from_lines(filter(_valid_rule, lines))
+
+def _files_ignore() -> Path:
+    return Path(".maxxignore") if Path(".maxxignore").exists() else Path(".gitignore")
 
+# `/a .` honours .maxxignore; the prompt tree follows .gitignore, like `tree --gitignore`
+IGNORE_SPEC = load_ignore_spec(_files_ignore())
+TREE_SPEC = load_ignore_spec(Path(".gitignore"))
+
+def _ignored(spec: pathspec.GitIgnoreSpec, rel: str, is_dir: bool = False) -> bool:
+    """Match a cwd-relative path; dirs need the trailing slash for `foo/` rules."""
+    return spec.match_file(rel + "/" if is_dir else rel)
+
+def repo_files() -> List[Path]:
+    root = os.getcwd()
+    files: List[Path] = []
+    stack = [(root, "")]
+    while stack:
+        d, rel = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    # DirEntry type checks come from readdir; only symlinks cost a stat
+                    if e.is_dir(follow_symlinks=False):
+                        # prune here so ignored subtrees are never entered
+                        if not _ignored(IGNORE_SPEC, rel + e.name, is_dir=True):
+                            stack.append((e.path, rel + e.name + "/"))
+                    elif e.is_file() and not _ignored(IGNORE_SPEC, rel + e.name):
+                        files.append(Path(e.path))
+        except OSError:
+            continue  # unreadable dir: skip it, as rglob did
+    return files
+
+@functools.lru_cache(maxsize=1)
+def _repo_files_at(bucket: int) -> tuple[Path, ...]:
+    return tuple(repo_files())
+
+def cached_repo_files(ttl: float = 2.0) -> List[Path]:
+    """repo_files(), reused for calls within the same `ttl`-second window."""
+    return list(_repo_files_at(int(time.monotonic() // ttl)))
+
+@functools.cache
+def _enc() -> tiktoken.Encoding | None:
+    """Load the BPE table once; None means fall back to TOKEN_FACTOR for good."""
+    try:
+        return tiktoken.encoding_for_model("gpt-4")
+    except Exception:
+        return None
+
+_enc()  # preload so the first /t doesn't pay for it
+
+def _token_counts(parts: List[str]) -> List[int]:
+    enc = _enc()
+    if enc is None:
+        return [int(len(p) * TOKEN_FACTOR) for p in parts]
+    # count only: no special-token scan, chunks encoded in parallel
+    return list(map(len, enc.encode_ordinary_batch(parts, num_threads=os.cpu_count() or 1)))
+
+def est_tokens(txt: str | List[str]) -> int:
+    """Count tokens of a string, or of a list of chunks encoded in parallel."""
+    return sum(_token_counts([txt] if isinstance(txt, str) else txt))
+
+# path -> (mtime_ns, size, prompt chunk, token count); replaced when the file changes
+_FILE_CACHE: Dict[str, tuple[int, int, str, int]] = {}
+
+def _read(p: Path) -> str:
+    """Repo files are read as UTF-8; undecodable bytes are replaced, not fatal."""
+    return p.read_bytes().decode("utf-8", errors="replace")
+
+def _stat_key(p: Path) -> tuple[str, int, int]:
+    st = p.stat()
+    return (str(p), st.st_mtime_ns, st.st_size)
+
+def file_chunks(paths: List[Path]) -> List[tuple[str, int]]:
+    """Prompt chunk and token count per file, re-read only after it changes."""
+    keys = [_stat_key(p) for p in paths]
+    misses = [k for k in keys if _FILE_CACHE.get(k[0], ())[:2] != k[1:]]
+    if misses:
+        chunks = [f"\n### {k[0]} ###\n{_read(Path(k[0]))}" for k in misses]
+        for (path, mtime, size), chunk, n in zip(misses, chunks, _token_counts(chunks)):
+            _FILE_CACHE[path] = (mtime, size, chunk, n)
+    return [_FILE_CACHE[k[0]][2:] for k in keys]
+
+def _render_tree() -> str:
+    """Render the working directory like `tree`, skipping hidden and ignored entries."""
+    root = os.getcwd()
+    lines = ["."]
+    n_dirs = n_files = 0
+
+    def walk(d: str, indent: str) -> None:
+        nonlocal n_dirs, n_files
+        try:
+            with os.scandir(d) as it:
+                entries = sorted(
+                    (
+                        e for e in it
+                        if not e.name.startswith(".")
+                        and not _ignored(TREE_SPEC, os.path.relpath(e.path, root), e.is_dir())
+                    ),
+                    key=lambda e: e.name,
+                )
+        except OSError:
+            return  # unreadable dir: show it, but not its contents
+        for i, e in enumerate(entries):
+            last = i == len(entries) - 1
+            lines.append(f"{indent}{'└── ' if last else '├── '}{e.name}")
+            if e.is_dir(follow_symlinks=False):
+                n_dirs += 1
+                walk(e.path, indent + ("    " if last else "│   "))
+            else:
+                n_files += 1
+
+    walk(root, "")
+    lines.append(f"\n{n_dirs} directories, {n_files} files\n")
+    return "\n".join(lines)
+
+@functools.cache
 def _safe_tree() -> str:
+    """Directory tree for the prompt, rendered once; /refresh clears it."""
+    try:
+        return _render_tree()
+    except OSError:
+        return ""
+
+def parse_file_listings(text: str) -> List[tuple[str, str]]:
     """
-    Render a directory tree that respects .gitignore.
-    Falls back to the old behavior if the installed `tree`
-    lacks the --gitignore flag.
+    Pull (filename, content) pairs out of an LLM reply: a filename line, then
+    a ``` fence (language tag allowed), then the content up to a bare ```.
+    One pass over the lines, so large replies never backtrack.
     """
+    listings: List[tuple[str, str]] = []
+    lines = text.split("\n")
+    i = 1
+    while i < len(lines):
+        fname = lines[i - 1].strip()
+        if fname and lines[i].lstrip().startswith("```"):
+            end = i + 1
+            while end < len(lines) and lines[end].strip() != "```":
+                end += 1
+            if end == len(lines):
+                break  # unterminated fence
+            listings.append((fname, "\n".join(lines[i + 1:end]).strip("\n")))
+            i = end + 2
+        else:
+            i += 1
+    return listings
+
+# flat JSON arrays anywhere in the reply, so ```json fences and prose are skipped
+_JSON_ARRAY_RE = re.compile(r"\[[^\[\]]*\]")
+
+def _as_paths(candidate: str) -> List[str] | None:
     try:
-        proc = subprocess.run(
-            ["tree", "--gitignore", "-I", ".git"],
-            text=True,
-            capture_output=True,
-            check=True,
-        )
-        return proc.stdout
-    except subprocess.CalledProcessError:
-        # `tree` executed but returned error
-        return proc.stdout or ""
-    except FileNotFoundError:
-        return ""
-    except Exception:
-        # Unsupported flag or other failure – fall back
-        fallback = subprocess.run(
-            ["tree", "-I", ".git"],
-            text=True,
-            capture_output=True,
-        ).stdout
-        warning = (
-            "[WARNING] Your installed `tree` does not support --gitignore. "
-            "Upgrade to v2+ for accurate output.\n"
-        )
-        return warning + fallback
+        picked = orjson.loads(candidate)
+    except orjson.JSONDecodeError:
+        return None
+    if isinstance(picked, list) and all(isinstance(f, str) for f in picked):
+        return picked
+    return None
+
+def parse_picked(raw: str) -> List[str]:
+    for m in _JSON_ARRAY_RE.finditer(raw):
+        if (picked := _as_paths(m.group(0))) is not None:
+            return picked
+    # paths like app/[slug]/page.tsx nest brackets: try the outermost span
+    start, end = raw.find("["), raw.rfind("]")
+    if 0 <= start < end and (picked := _as_paths(raw[start:end + 1])) is not None:
+        return picked
+    return orjson.loads(raw)
+
+async def _safe_tree_async() -> str:
+    """_safe_tree() without blocking the event loop on a cold cache."""
+    return await asyncio.to_thread(_safe_tree)
+
+def refresh_tree() -> None:
+    global IGNORE_SPEC, TREE_SPEC
+    IGNORE_SPEC = load_ignore_spec(_files_ignore())
+    TREE_SPEC = load_ignore_spec(Path(".gitignore"))
+    _safe_tree.cache_clear()
 
 # ──────────────────────── command registry ───────────────────────────── #
 
@@ -157,6 +308,7 @@ COMMANDS: Dict[str, str] = {
     "/t": "Estimate tokens of current prompt",
     "/c": "Copy current prompt to clipboard",
     "/p": "Paste output from clipboard and apply edits",
+    "/refresh": "Re-read ignore rules and re-scan the directory tree",
     "/h": "Show this help message",
 }
 
@@ -199,6 +351,10 @@ class PromptMaxx(App):
 
     sel_files: reactive[List[Path]] = reactive([])
     prompt_cache: reactive[str] = reactive("")
+    _last_changed: str = ""
+    _prompt_dirty: bool = True
+    _prompt_key: List[tuple[str, int, int]] = []
+    _token_cache: int | None = None
 
     # ─────────────────── compose ─────────────────── #
 
@@ -217,13 +373,38 @@ class PromptMaxx(App):
     def refresh_files(self) -> None:
         pane = self.query_one(FilePane)
         pane.files = list(self.sel_files)
+        self._prompt_dirty = True
 
-    def build_prompt(self) -> str:
+    def prompt_head(self) -> List[str]:
         tree = _safe_tree() if CFG["show_tree_before_files"] else ""
-        parts = [CFG["prompt_prefix"], tree]
-        for p in self.sel_files:
-            parts.append(f"\n### {p} ###\n{p.read_text()}")
-        return "".join(parts)
+        return [CFG["prompt_prefix"], tree]
+
+    def _check_prompt(self) -> None:
+        """Drop the cached prompt if the selection, tree or any selected file changed."""
+        key = [_stat_key(p) for p in self.sel_files]
+        if self._prompt_dirty or key != self._prompt_key:
+            self._prompt_key = key
+            self._prompt_dirty = False
+            self.prompt_cache = ""
+            self._token_cache = None
+
+    def prompt_tokens(self) -> int:
+        self._check_prompt()
+        if self._token_cache is None:
+            files = sum(n for _, n in file_chunks(self.sel_files))
+            self._token_cache = est_tokens(self.prompt_head()) + files
+        return self._token_cache
+
+    def build_prompt(self) -> str:
+        self._check_prompt()
+        if not self.prompt_cache:
+            buf = io.StringIO()
+            for part in self.prompt_head():
+                buf.write(part)
+            for chunk, _ in file_chunks(self.sel_files):
+                buf.write(chunk)
+            self.prompt_cache = buf.getvalue()
+        return self.prompt_cache
 
     # ────────────────── lifecycle ─────────────────── #
 
@@ -250,16 +431,21 @@ class PromptMaxx(App):
 
     async def on_input_changed(self, ev: Input.Changed) -> None:
         text = ev.value
+        if text.startswith(("/r ", "/a ")):
+            # only react once a token is finished, and only to new input
+            if not text.endswith(" ") or text == self._last_changed:
+                return
+            self._last_changed = text
+        else:
+            self._last_changed = ""  # e.g. cleared on submit; the same text may come again
         if text.startswith("/r "):
-            rem = set(shlex.split(text[3:]))
+            # plain split while typing; quoted names are handled on submit
+            rem = set(text[3:].split())
             self.sel_files = [p for p in self.sel_files if str(p) not in rem]
             self.refresh_files()
         elif text.startswith("/a "):
-            args = shlex.split(text[3:])
-            if "." in args:
-                args.remove(".")
-                args.extend(map(str, repo_files()))
-            for f in args:
+            # "." is expanded on submit, not while typing
+            for f in text[3:].split():
                 p = Path(f)
                 if p.is_file() and p not in self.sel_files:
                     self.sel_files.append(p)
@@ -277,10 +463,16 @@ class PromptMaxx(App):
         )
         out, _ = await proc.communicate()
         self.write_log(f"$ {cmd}\n{out.decode()}")
+        _safe_tree.cache_clear()  # the command may have created or removed files
+        self._prompt_dirty = True
 
     async def run_cmd(self, txt: str) -> None:
         if txt.startswith("/a "):
-            for f in shlex.split(txt[3:]):
+            args = shlex.split(txt[3:])
+            if "." in args:
+                args.remove(".")
+                args.extend(map(str, cached_repo_files()))
+            for f in args:
                 p = Path(f)
                 if p.exists() and p not in self.sel_files:
                     self.sel_files.append(p)
@@ -290,13 +482,16 @@ class PromptMaxx(App):
             self.sel_files = [p for p in self.sel_files if str(p) not in rem]
             self.refresh_files()
         elif txt == "/t":
-            self.write_log(f"Tokens ≈ {est_tokens(self.build_prompt())}")
+            self.write_log(f"Tokens ≈ {self.prompt_tokens()}")
         elif txt == "/c":
-            self.prompt_cache = self.build_prompt()
-            pyperclip.copy(self.prompt_cache)
+            await asyncio.to_thread(pyperclip.copy, self.build_prompt())
             self.write_log("[cyan]Prompt copied[/cyan]")
         elif txt == "/p":
             await self.handle_paste()
+        elif txt == "/refresh":
+            refresh_tree()
+            self._prompt_dirty = True
+            self.write_log("[cyan]Directory tree refreshed[/cyan]")
         elif txt in {"/", "/h", "/help"}:
             self.show_help()
         else:
@@ -309,17 +504,19 @@ class PromptMaxx(App):
     # ────────────────── LLM interaction ───────────── #
 
     async def handle_paste(self) -> None:
-        paste = pyperclip.paste()
-        self.write_log("[magenta]Pasted output:[/magenta]\n" + paste)
         try:
-            files = await self.call_picker(paste)
+            # render the tree while the clipboard is being read
+            tree, paste = await asyncio.gather(
+                _safe_tree_async(), asyncio.to_thread(pyperclip.paste)
+            )
+            self.write_log("[magenta]Pasted output:[/magenta]\n" + paste)
+            files = await self.call_picker(paste, tree)
         except Exception as exc:
             self.show_exc(exc)
             return
         await self.call_editor(paste, files)
 
-    async def call_picker(self, paste: str) -> List[str]:
-        tree = _safe_tree()
+    async def call_picker(self, paste: str, tree: str) -> List[str]:
         resp = await asyncio.to_thread(
             litellm.completion,
             model=CFG["model_id"],
@@ -331,7 +528,7 @@ class PromptMaxx(App):
         )
         raw = resp["choices"][0]["message"]["content"]
         try:
-            picked: List[str] = json.loads(raw)
+            picked = parse_picked(raw)
             self.write_log(f"[green]Picker chose:[/green] {picked}")
             return picked
         except Exception:
@@ -340,37 +537,52 @@ class PromptMaxx(App):
     async def call_editor(self, paste: str, files: List[str]) -> None:
         def read_text(f: str) -> str:
             try:
-                return Path(f).read_text()
+                return _read(Path(f))
             except Exception:
                 return ""
-        payload = "\n\n".join(f"### {f}\n{read_text(f)}" for f in files if Path(f).exists())
-        self.write_log(str([
+        existing = [f for f in files if Path(f).exists()]
+        texts = await asyncio.gather(*(asyncio.to_thread(read_text, f) for f in existing))
+        payload = "\n\n".join(f"### {f}\n{t}" for f, t in zip(existing, texts))
+        messages = [
             {"role": "system", "content": CFG["editing_prompt"]},
             {"role": "user", "content": paste + "\n\n--- FILES ---\n" + payload},
-        ]))
+        ]
+        if CFG["debug"]:
+            self.write_log(str(messages))
+        else:
+            tokens = await asyncio.to_thread(est_tokens, [CFG["editing_prompt"], paste, *texts])
+            self.write_log(
+                f"[dim]Editor request: {len(existing)} file(s), ~{tokens} tokens[/dim]"
+            )
         resp = await asyncio.to_thread(
             litellm.completion,
             model=CFG["model_id"],
             api_key=API_KEY,
-            messages=[
-                {"role": "system", "content": CFG["editing_prompt"]},
-                {"role": "user", "content": paste + "\n\n--- FILES ---\n" + payload},
-            ],
+            messages=messages,
         )
         out = resp["choices"][0]["message"]["content"]
         self.write_log(out)
         await self.apply_file_listings(out)
 
     async def apply_file_listings(self, text: str) -> None:
-        pattern = re.compile(r"([^\n]+?)\n```([\s\S]*?)```")
-        for match in pattern.finditer(text):
-            fname, content = match.group(1).strip(), match.group(2).strip("\n")
+        await asyncio.to_thread(self.write_listings, parse_file_listings(text))
+        _safe_tree.cache_clear()  # edits may have created files
+        self._prompt_dirty = True
+
+    def write_listings(self, listings: List[tuple[str, str]]) -> None:
+        """Runs in a worker thread, so logging goes through call_from_thread."""
+        seen_dirs: set[Path] = set()
+        for fname, content in listings:
             try:
-                Path(fname).parent.mkdir(parents=True, exist_ok=True)
-                Path(fname).write_text(content)
-                self.write_log(f"[green]Updated {fname}[/green]")
+                parent = Path(fname).parent
+                if parent not in seen_dirs:
+                    parent.mkdir(parents=True, exist_ok=True)
+                    seen_dirs.add(parent)
+                with open(fname, "w", encoding="utf-8", buffering=1 << 16) as fh:
+                    fh.write(content)
+                self.call_from_thread(self.write_log, f"[green]Updated {fname}[/green]")
             except Exception as exc:
-                self.show_exc(exc)
+                self.call_from_thread(self.show_exc, exc)
 
     # ─────────────────────── misc ─────────────────────── #
 